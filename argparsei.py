@@ -1,6 +1,13 @@
 import argparse
 
 class InteractiveArgumentParser(argparse.ArgumentParser):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Subcommands whose lines can be parsed without argparse, keyed by
+        # name; each takes the tokens after the name and returns a namespace,
+        # or None to fall back to argparse
+        self.fast_commands = {}
+
     def exit(self, status=0, message=None):
         if message:
             raise argparse.ArgumentError(argument=None, message=message)
\ No newline at end of file
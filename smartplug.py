@@ -1,8 +1,18 @@
+from __future__ import annotations
 import zcs
+import os
 import asyncio
+import functools
+import collections
+import contextlib
 from datetime import datetime
-from bleak import BleakClient
-from collections.abc import AsyncGenerator
+from collections.abc import AsyncIterator, Callable
+from typing import Any, TYPE_CHECKING
+
+# Clients are only ever passed in, never created here, so bleak (and its
+# platform backend) is not imported just to use the packet helpers
+if TYPE_CHECKING:
+    from bleak import BleakClient
 
 class ResponseMismatchError(Exception):
     pass
@@ -13,81 +23,276 @@ class SmartplugBusyError(Exception):
 class MalformedCommandError(Exception):
     pass
 
-async def send_command(client: BleakClient, packet: bytearray) -> bytearray:
-    await client.write_gatt_char(zcs.COMMAND_PIPE, data=packet,
-                                        response=True)
-    return await client.read_gatt_char(zcs.COMMAND_PIPE)
-
-async def send_commands(clients: list[BleakClient],
-                        packet: bytearray) -> AsyncGenerator[bytearray]:
-    response_queue = asyncio.Queue()
-    tasks = set()
-    for client in clients:
-        task = asyncio.create_task(send_command(client, packet))
-        tasks.add(task)
-        def done_callback(task):
-            try:
-                response_queue.put_nowait(task.result())
-            except Exception:
-                # Ignore exceptions
-                response_queue.put_nowait(bytearray())
-        task.add_done_callback(done_callback)
-    for i in range(len(clients)):
-        yield await response_queue.get()
-
-async def send_commands_deaf(clients: list[BleakClient], packet: bytearray):
-    await asyncio.gather(*[send_command(client, packet) for client in clients])
-
-def on(clients: list[BleakClient], brightness=0):
-    return send_commands(clients, zcs.on(brightness))
-
-def off(clients: list[BleakClient]):
-    return send_commands(clients, zcs.off())
-
-def set_mode(clients: list[BleakClient], is_appliance = True):
-    return send_commands(clients, zcs.set_mode(is_appliance))
-
-def sync_clock(clients: list[BleakClient]):
-    return send_commands(clients, zcs.set_clock(datetime.today()))
-
-async def get_clock(clients: list[BleakClient]):
-    async for response in send_commands(clients, zcs.get_clock()):
-        yield zcs.parse_get_clock(response)
-
-async def read_power(clients: list[BleakClient]):
-    async for response in send_commands(clients, zcs.read_power()):
-        yield zcs.parse_read_power(response)
-
-def add_schedule(clients: list[BleakClient], schedule: zcs.Schedule):
-    return send_commands(clients, zcs.add_schedule(schedule))
-
-async def get_schedule(clients: list[BleakClient], i: int):
-    return zcs.parse_get_schedule(await send_command(clients[0],
-                                                     zcs.get_schedule(i)))
-
-async def get_client_schedule_info(clients: list[BleakClient]):
-    return zcs.parse_get_schedule_info(await send_command(clients[0],
-                                                   zcs.get_schedule_info()))
-
-async def get_client_schedules(clients: list[BleakClient]):
+class MissingCommandPipeError(Exception):
+    pass
+
+RESPONSE_TIMEOUT = 5.0
+
+# bleak accepts any buffer when writing, so packets need not be copied into a
+# bytearray before being sent
+Packet = bytes | bytearray | memoryview
+
+# Decodes a raw response into whatever a command returns
+Parser = Callable[[bytearray], Any]
+
+# Caps the number of GATT operations in flight across all smartplugs, since
+# the host adapter can only schedule so many per connection event; set
+# ZULI_MAX_BLE_OPS to tune it for a particular adapter
+_ble_ops = asyncio.Semaphore(int(os.environ.get('ZULI_MAX_BLE_OPS', 8)))
+
+class CommandPipe():
+    """Tracks the command in flight on a single smartplug
+
+    Responses are delivered as notifications on the command pipe rather than
+    read back after each write where the smartplug supports it. A response
+    echoes the command code in its first byte, which is used to match it to
+    the pending command; responses that match nothing pending (e.g. one that
+    arrives after its command timed out) are dropped."""
+    def __init__(self, notify: bool, response: bool):
+        self.notify = notify
+        self.response = response
+        self.lock = asyncio.Lock()
+        self.code_locks: collections.defaultdict[int, asyncio.Lock] = \
+            collections.defaultdict(asyncio.Lock)
+        self.pending: dict[int, tuple[asyncio.Future, Parser | None]] = {}
+
+    def lock_for(self, code: int) -> asyncio.Lock:
+        """Returns the lock to hold while sending a command with the given code
+
+        Commands with the same code are serialized since their responses cannot
+        be told apart, while commands with different codes may be in flight at
+        once. Without notifications every response is read from the same
+        characteristic, so all commands are serialized."""
+        return self.code_locks[code] if self.notify else self.lock
+
+    def on_response(self, _, data: bytearray) -> None:
+        if len(data) == 0:
+            return
+        future, parse = self.pending.pop(data[0], (None, None))
+        if future is None or future.done():
+            return
+        # Responses are decoded as soon as they arrive so the waiting command
+        # resumes with its result
+        try:
+            future.set_result(data if parse is None else parse(data))
+        except Exception as e:
+            future.set_exception(e)
+
+_pipes: dict[BleakClient, CommandPipe] = {}
+_ready: dict[BleakClient, asyncio.Event] = {}
+
+async def connect(client: BleakClient) -> None:
+    """Connects to a smartplug and subscribes to responses on its command pipe,
+    falling back to reading the pipe after each write if the smartplug does not
+    support notifications"""
+    ready = _ready.setdefault(client, asyncio.Event())
+    try:
+        await client.connect()
+        characteristic = client.services.get_characteristic(zcs.COMMAND_PIPE)
+        if characteristic is None:
+            raise MissingCommandPipeError(
+                f"{client.address} has no command pipe ({zcs.COMMAND_PIPE})")
+        properties = characteristic.properties
+        pipe = CommandPipe(notify='notify' in properties,
+                           response='write-without-response' not in properties)
+        if pipe.notify:
+            await client.start_notify(zcs.COMMAND_PIPE, pipe.on_response)
+    except BaseException:
+        _ready.pop(client, None)
+        # A link left up on a client the caller is about to abandon would never
+        # be closed, and the smartplug would stop advertising for a retry
+        if client.is_connected:
+            with contextlib.suppress(Exception):
+                await client.disconnect()
+        raise
+    _pipes[client] = pipe
+    ready.set()
+
+def is_ready(client: BleakClient) -> bool:
+    """Returns whether a smartplug has finished connecting and can be sent
+    commands"""
+    return client in _pipes and client.is_connected
+
+async def wait_ready(client: BleakClient, timeout: float) -> bool:
+    """Waits up to timeout seconds for a smartplug to finish connecting,
+    returning whether it can be sent commands"""
+    ready = _ready.setdefault(client, asyncio.Event())
+    try:
+        await asyncio.wait_for(ready.wait(), timeout)
+    except TimeoutError:
+        pass
+    return is_ready(client)
+
+async def disconnect(client: BleakClient) -> None:
+    _pipes.pop(client, None)
+    _ready.pop(client, None)
+    await client.disconnect()
+
+async def _write_then_read(client: BleakClient, packet: Packet,
+                           parse: Parser | None) -> Any:
+    async with _ble_ops:
+        await client.write_gatt_char(zcs.COMMAND_PIPE, data=packet,
+                                     response=True)
+    async with _ble_ops:
+        response = await client.read_gatt_char(zcs.COMMAND_PIPE)
+    return response if parse is None else parse(response)
+
+async def send_command(client: BleakClient, packet: Packet,
+                       parse: Parser | None = None) -> Any:
+    """Sends a packet to a smartplug and returns its response, decoded with
+    parse if one is given"""
+    pipe = _pipes.get(client)
+    if pipe is None:
+        return await _write_then_read(client, packet, parse)
+    code = packet[0]
+    async with pipe.lock_for(code):
+        if not pipe.notify:
+            return await _write_then_read(client, packet, parse)
+        future = asyncio.get_running_loop().create_future()
+        pipe.pending[code] = (future, parse)
+        try:
+            async with _ble_ops:
+                await client.write_gatt_char(zcs.COMMAND_PIPE, data=packet,
+                                             response=pipe.response)
+            return await asyncio.wait_for(future, RESPONSE_TIMEOUT)
+        finally:
+            pipe.pending.pop(code, None)
+
+async def send_command_noreply(client: BleakClient, packet: Packet) -> bool:
+    """Sends a packet to a smartplug without waiting for its response, returning
+    True once the smartplug acknowledges the write
+
+    Suited to commands that only change state, where the acknowledgement is
+    confirmation enough and reading back the response would cost another round
+    trip."""
+    pipe = _pipes.get(client)
+    if pipe is None:
+        async with _ble_ops:
+            await client.write_gatt_char(zcs.COMMAND_PIPE, data=packet,
+                                         response=True)
+        return True
+    # The lock only matters on the write-then-read fallback (pipe.lock), where
+    # this write must not land between another command's write and read. On a
+    # notifying smartplug it is released once the write is acknowledged,
+    # before the ignored response arrives; that response is dropped because
+    # it matches no pending command code, not because of the lock
+    async with pipe.lock_for(packet[0]), _ble_ops:
+        await client.write_gatt_char(zcs.COMMAND_PIPE, data=packet,
+                                     response=True)
+    return True
+
+async def send_commands(clients: list[BleakClient], packet: Packet,
+                        parse: Parser | None = None,
+                        reply: bool = True) -> AsyncIterator[Any]:
+    """Sends a packet to every smartplug, yielding responses as they arrive
+
+    :param reply: if False, the smartplugs' responses are not waited for and
+        True is yielded for each acknowledged write instead
+    """
+    # Every write in the broadcast shares one read-only view of the packet
+    if isinstance(packet, bytearray):
+        packet = memoryview(packet).toreadonly()
+    if reply:
+        tasks = [asyncio.create_task(send_command(client, packet, parse))
+                 for client in clients]
+    else:
+        tasks = [asyncio.create_task(send_command_noreply(client, packet))
+                 for client in clients]
+    for task in asyncio.as_completed(tasks):
+        try:
+            yield await task
+        except Exception:
+            # Ignore exceptions
+            yield bytearray() if reply else False
+
+async def send_commands_deaf(clients: list[BleakClient],
+                             packet: Packet) -> None:
+    # Exceptions are collected rather than raised so that one unresponsive
+    # smartplug does not abandon the rest of the broadcast
+    await asyncio.gather(*[send_command_noreply(client, packet)
+                           for client in clients], return_exceptions=True)
+
+# Brightness only spans 0 to 100, so on packets are encoded once per
+# brightness and shared by every write
+@functools.lru_cache(maxsize=256)
+def _on_pkt(brightness: int) -> bytes:
+    return zcs.on(brightness)
+
+def on(clients: list[BleakClient],
+       brightness: int = 0) -> AsyncIterator[bool]:
+    return send_commands(clients, _on_pkt(brightness), reply=False)
+
+def off(clients: list[BleakClient]) -> AsyncIterator[bool]:
+    return send_commands(clients, zcs.off(), reply=False)
+
+def set_mode(clients: list[BleakClient],
+             is_appliance: bool = True) -> AsyncIterator[bool]:
+    return send_commands(clients, zcs.set_mode(is_appliance), reply=False)
+
+def sync_clock(clients: list[BleakClient],
+               when: datetime | None = None) -> AsyncIterator[bool]:
+    """Sets the clock of every client to the same timestamp
+
+    :param when: the time to set; defaults to the current time
+    """
+    return send_commands(clients, zcs.set_clock(when), reply=False)
+
+def get_clock(clients: list[BleakClient]) -> AsyncIterator[datetime]:
+    return send_commands(clients, zcs.get_clock(), zcs.parse_get_clock)
+
+def read_power(
+        clients: list[BleakClient]) -> AsyncIterator[tuple[int, int, int, int]]:
+    return send_commands(clients, zcs.read_power(), zcs.parse_read_power)
+
+def add_schedule(clients: list[BleakClient],
+                 schedule: zcs.Schedule) -> AsyncIterator[int]:
+    """Adds a schedule to every client, yielding each response status
+
+    Unlike the other state changes this waits for the response, since a
+    smartplug can acknowledge the write and still reject the schedule (e.g.
+    when its schedule table is full)."""
+    return send_commands(clients, zcs.add_schedule(schedule),
+                         zcs.parse_response_status)
+
+async def get_schedule(clients: list[BleakClient], i: int) -> zcs.Schedule:
+    return await send_command(clients[0], zcs.get_schedule(i),
+                              zcs.parse_get_schedule)
+
+async def get_client_schedule_info(
+        clients: list[BleakClient]) -> tuple[int, int]:
+    return await send_command(clients[0], zcs.get_schedule_info(),
+                              zcs.parse_get_schedule_info)
+
+async def get_client_schedules(
+        clients: list[BleakClient]) -> AsyncIterator[zcs.Schedule]:
     schedule_info = await get_client_schedule_info(clients)
     num_schedules = schedule_info[0]
+    # Every request has the same command code, so their responses cannot be
+    # told apart and the requests have to run one after another anyway
     for i in range(1, num_schedules + 1):
         yield await get_schedule(clients, i)
 
-async def remove_client_schedule(clients: list[BleakClient], i: int):
+async def remove_client_schedule(clients: list[BleakClient], i: int) -> int:
+    """Removes the i-th schedule, returning the response status, which tells
+    whether the smartplug actually removed it"""
     schedule = await get_schedule(clients, i)
-    yield await send_command(clients[0], zcs.remove_schedule(schedule))
+    return await send_command(clients[0], zcs.remove_schedule(schedule),
+                              zcs.parse_response_status)
 
-async def poll_all_commands(client: BleakClient):
+async def poll_all_commands(
+        client: BleakClient) -> AsyncIterator[tuple[int, bytearray]]:
     for code in range(256):
         yield (code, await send_command(client, bytearray([code])))
 
-async def poll_command(client: BleakClient, command: int):
-    packet = bytearray([command])
+async def poll_command(client: BleakClient,
+                       command: int) -> AsyncIterator[tuple[int, str]]:
+    # Grow the packet one zero byte at a time by writing successively longer
+    # views of a single buffer
+    packet = bytearray(16)
+    packet[0] = command
+    view = memoryview(packet)
     for i in range(15):
-        packet.append(0)
-        response = await send_command(client, packet)
+        response = await send_command(client, view[:i + 2])
         if len(response) < 2 or response[1] != 15:
             yield (i + 1, response.hex())
             break
\ No newline at end of file
@@ -2,6 +2,7 @@
 interpret Zuli protocol packets.
 """
 import datetime
+import struct
 
 ZULI_SERVICE = '04ee929b-bb13-4e77-8160-18552daf06e1'
 COMMAND_PIPE = 'ffffff03-bb13-4e77-8160-18552daf06e1'
@@ -42,26 +43,44 @@ STATUS_INVALID_PARAM = 6
 STATUS_BAD_LENGTH = 15
 STATUS_ALREADY_SET = 9
 
-def parse_response_status(response: bytearray) -> tuple:
+def parse_response_status(response: bytearray) -> int:
     """Returns the response status, effectively returning the second byte in
     the response"""
     return response[1]
 
-def on(brightness = 0) -> bytearray:
+# Packets with a fixed layout are packed with precompiled structs
+_ON = struct.Struct('>B4xB3x')
+_OFF = struct.Struct('>B3x')
+_SET_MODE = struct.Struct('>BB')
+_COMMAND = struct.Struct('>B')
+_GET_SCHEDULE = struct.Struct('>BB')
+_GET_SCHEDULE_INFO = struct.Struct('>Bx')
+# Command, year, month, day, weekday, hour, minute, second
+_SET_CLOCK = struct.Struct('>BHBBBBBB')
+
+# Packets for commands without parameters never change, so they are packed
+# once and the same object is returned on every call
+_OFF_PACKET = _OFF.pack(CMD_OFF)
+_GET_CLOCK_PACKET = _COMMAND.pack(CMD_CLOCK_GET)
+_READ_POWER_PACKET = _COMMAND.pack(CMD_POWER_READ)
+_GET_SCHEDULE_INFO_PACKET = _GET_SCHEDULE_INFO.pack(CMD_SCHEDULE_INFO_GET)
+
+def on(brightness = 0) -> bytes:
     """Creates a packet to turn a smartplug on, optionally at a specified
     brightness
     
     :param brightness: a number between 0 and 100 (otherwise will be trimmed);
         note that this defaults to 0, which is functionally equivalent to 100;
         brightness is ignored by the smartplug when in appliance mode"""
-    brightness = min(100, max(0, brightness))
-    return bytearray([CMD_ON, 0, 0, 0, 0, brightness, 0, 0, 0])
+    brightness = (0 if brightness < 0 else
+                  100 if brightness > 100 else brightness)
+    return _ON.pack(CMD_ON, brightness)
 
-def off() -> bytearray:
+def off() -> bytes:
     """Creates a packet to turn a smartplug off"""
-    return bytearray([CMD_OFF, 0, 0, 0])
+    return _OFF_PACKET
 
-def set_mode(is_appliance = True) -> bytearray:
+def set_mode(is_appliance = True) -> bytes:
     """Creates a packet to set the mode of a smartplug
     
     :param is_appliance: by default True, indicating that the smartplug is
@@ -70,111 +89,132 @@ def set_mode(is_appliance = True) -> bytearray:
         dimming
     """
     mode = 0 if is_appliance else 1
-    return bytearray([CMD_MODE_SET, mode])
+    return _SET_MODE.pack(CMD_MODE_SET, mode)
 
-def set_clock(time: datetime.datetime) -> bytearray:
+def set_clock(time: datetime.datetime | None = None) -> bytes:
     """Creates a packet to set the clock of a smartplug
 
     Smartplugs track their own system time for use with schedules, though this
     time does not persist past power cycles.
+
+    :param time: the time to set; defaults to the current time when the packet
+        is created
     """
-    year = time.year.to_bytes(2)
+    if time is None:
+        time = datetime.datetime.now()
     weekday = ((time.weekday() + 1) % 7) + 1
-    return bytearray([CMD_CLOCK_SET, year[0], year[1], time.month, time.day,
-                      weekday, time.hour, time.minute, time.second])
+    return _SET_CLOCK.pack(CMD_CLOCK_SET, time.year, time.month, time.day,
+                           weekday, time.hour, time.minute, time.second)
 
-def get_clock() -> bytearray:
+def get_clock() -> bytes:
     """Creates a packet to poll the current system time on a smartplug"""
-    return bytearray([CMD_CLOCK_GET])
+    return _GET_CLOCK_PACKET
+
+# Year, month, day, (weekday), hour, minute, second
+_GET_CLOCK_RESPONSE = struct.Struct('>HBBxBBB')
 
 def parse_get_clock(response: bytearray) -> datetime.datetime:
     """Produces a datetime object from a get clock packet and fails if the
     packet is malformed"""
-    year = int.from_bytes(response[2:4])
-    return datetime.datetime(year, month=response[4], day=response[5],
-                             hour=response[7], minute=response[8],
-                             second=response[9])
+    year, month, day, hour, minute, second = \
+        _GET_CLOCK_RESPONSE.unpack_from(response, 2)
+    return datetime.datetime(year, month=month, day=day, hour=hour,
+                             minute=minute, second=second)
 
-def read_power() -> bytearray:
+def read_power() -> bytes:
     """Creates a packet to read current power consumption"""
-    return bytearray([CMD_POWER_READ])
+    return _READ_POWER_PACKET
+
+# Current, power (3 bytes), power factor, voltage (3 bytes); struct has no
+# 3 byte integers so those are split into their high byte and low two bytes
+_READ_POWER_RESPONSE = struct.Struct('>HBHHBH')
 
 def parse_read_power(response: bytearray) -> tuple[int, int, int, int]:
     """Returns the current power consumption in watts from a read power packet
     and fails if the packet is malformed"""
-    irms_ma = int.from_bytes(response[2:4])
-    power_mw = int.from_bytes(response[4:7])
-    power_factor = int.from_bytes(response[7:9])
-    voltage_mv = int.from_bytes(response[9:12])
+    irms_ma, power_hi, power_lo, power_factor, voltage_hi, voltage_lo = \
+        _READ_POWER_RESPONSE.unpack_from(response, 2)
+    power_mw = power_hi << 16 | power_lo
+    voltage_mv = voltage_hi << 16 | voltage_lo
     return (irms_ma, power_mw, power_factor, voltage_mv)
 
+# Schedules store weekdays as a bitfield with Sunday in the lowest bit, while
+# datetime (and Schedule) count from Monday; these tables map between the two
+_WEEKDAY_SHIFTS = tuple((i + 1) % 7 for i in range(7))
+_DECODE_WEEKDAYS = tuple(tuple(b & 1 << shift != 0
+                               for shift in _WEEKDAY_SHIFTS)
+                         for b in range(256))
+
+# Id, action, hour, minute, second, weekdays, enabled, schedule id
+_SCHEDULE = struct.Struct('>BBxxBBBBBB')
+_ADD_SCHEDULE = struct.Struct('>B10s')
+_REMOVE_SCHEDULE = struct.Struct('>Bx7s')
+
 class Schedule():
     """A representation of a schedule that can be used to turn a smartplug on
     or off at a specific time"""
     ACTION_ON = 1
     ACTION_OFF = 2
     WEEKDAY_SYMBOL = "MTWTFSS"
+    __slots__ = ('id', 'action', 'time', 'weekdays', 'enabled', 'schedule_id')
 
     def __init__(self, time: datetime.time, id=0, action=ACTION_ON,
-                 weekdays=[True] * 7, enabled=True, schedule_id=0):
+                 weekdays=None, enabled=True, schedule_id=0):
+        """Creates a schedule
+
+        :param weekdays: seven booleans from Monday to Sunday; by default the
+            schedule runs every day
+        """
         self.id = id
         self.action = action
         self.time = time
-        self.weekdays = weekdays
+        self.weekdays = (True,) * 7 if weekdays is None else tuple(weekdays)
         self.enabled = enabled
         self.schedule_id = schedule_id
 
-    def from_bytes(raw: bytearray):
-        id = raw[0]
-        action = raw[1]
-        time = datetime.time(hour=raw[4], minute=raw[5], second=raw[6])
+    @staticmethod
+    def from_bytes(raw: bytearray, offset=0) -> 'Schedule':
+        """Reads a schedule from the 10 bytes of raw starting at offset, which
+        lets a schedule be read from a response without slicing it out first"""
+        id, action, hour, minute, second, weekdays, enabled, schedule_id = \
+            _SCHEDULE.unpack_from(raw, offset)
+        time = datetime.time(hour=hour, minute=minute, second=second)
         # Represented from index 0 == Monday ... 6 == Sunday as does datetime,
         # note that this is a departure from the way the smartplugs consider
         # Sunday to be the first day of the week
-        weekdays = []
-        for i in range(7):
-            # Account for weeks beginning on different days
-            i = (i + 1) % 7
-            bitflag = 1 << i
-            weekdays.append(raw[7] & bitflag == bitflag)
-        enabled = raw[8] == 1
-        schedule_id = raw[9]
+        weekdays = _DECODE_WEEKDAYS[weekdays]
+        enabled = enabled == 1
         return Schedule(time, id=id, action=action, weekdays=weekdays,
                         enabled=enabled, schedule_id=schedule_id)
 
-    def to_bytes(self) -> bytearray:
-        weekdays = 0
-        for i in range(7):
-            # Account for weeks beginning on different days
-            shift = (i + 1) % 7
-            bitflag = self.weekdays[i] << shift
-            weekdays |= bitflag
-        return bytearray([self.id, self.action, 0, 0, self.time.hour,
-                      self.time.minute, self.time.second, weekdays,
-                      self.enabled, self.schedule_id])
+    def to_bytes(self) -> bytes:
+        mo, tu, we, th, fr, sa, su = self.weekdays
+        weekdays = (su | mo << 1 | tu << 2 | we << 3 | th << 4 | fr << 5
+                    | sa << 6)
+        time = self.time
+        return _SCHEDULE.pack(self.id, self.action, time.hour, time.minute,
+                              time.second, weekdays, self.enabled,
+                              self.schedule_id)
     
-    def as_anonymous(self) -> bytearray:
+    def as_anonymous(self) -> bytes:
         """Returns a trimmed byte representation of the schedule without
         identifiers, useful when removing schedules"""
         raw = self.to_bytes()
         return raw[1:8]
     
     def __str__(self):
-        weekdays_sym = map(lambda i : self.WEEKDAY_SYMBOL[i]
-                           if self.weekdays[i] else "-", range(7))
-        weekdays_str = " ".join(weekdays_sym)
+        weekdays_str = " ".join([symbol if on else "-" for symbol, on
+                                 in zip(self.WEEKDAY_SYMBOL, self.weekdays)])
         action_str = "Turn On" if self.action == self.ACTION_ON else "Turn Off"
         enabled_str = "Enabled" if self.enabled else "Disabled"
         return f"{action_str}  {weekdays_str}  at {self.time.isoformat()} ({enabled_str})"
 
-def add_schedule(schedule: Schedule) -> bytearray:
+def add_schedule(schedule: Schedule) -> bytes:
     """Creates a packet to push a new schedule to the smartplug
     """
-    packet = bytearray([CMD_SCHEDULE_ADD])
-    packet.extend(schedule.to_bytes())
-    return packet
+    return _ADD_SCHEDULE.pack(CMD_SCHEDULE_ADD, schedule.to_bytes())
 
-def get_schedule(i: int) -> bytearray:
+def get_schedule(i: int) -> bytes:
     """Creates a packet to get a single schedule saved to the smartplug
 
     This packet will typically be sent n times, n being the number of schedules
@@ -185,71 +225,77 @@ def get_schedule(i: int) -> bytearray:
         the number that corresponds to a specific schedule does not stay the
         same between operations that change schedules
     """
-    return bytearray([CMD_SCHEDULE_GET, i])
+    return _GET_SCHEDULE.pack(CMD_SCHEDULE_GET, i)
 
 def parse_get_schedule(response: bytearray) -> Schedule:
     """Returns a single schedule from a get schedule packet and fails if the
     packet is malformed"""
-    return Schedule.from_bytes(response[2:])
+    return Schedule.from_bytes(response, 2)
 
-def get_schedule_info() -> bytearray:
+def get_schedule_info() -> bytes:
     """Creates a packet to get schedule info"""
-    return bytearray([CMD_SCHEDULE_INFO_GET, 0])
+    return _GET_SCHEDULE_INFO_PACKET
 
 def parse_get_schedule_info(response: bytearray) -> tuple[int, int]:
     """Returns a tuple of the number of events and the maximum supported number
     and fails if the packet is malformed"""
     return (response[2], response[3])
 
-def remove_schedule(schedule: Schedule) -> bytearray:
+def remove_schedule(schedule: Schedule) -> bytes:
     """Creates a packet to remove a single schedule saved to the smartplug"""
-    packet = bytearray([CMD_SCHEDULE_REMOVE, 0])
-    packet.extend(schedule.as_anonymous())
-    return packet
+    return _REMOVE_SCHEDULE.pack(CMD_SCHEDULE_REMOVE, schedule.as_anonymous())
 
-def remove_all_schedules() -> bytearray:
+# Command, confirmation
+_REMOVE_ALL_SCHEDULES = struct.Struct('>BH')
+
+def remove_all_schedules() -> bytes:
     """Untested. Reconstructed from Zuli Android app"""
-    packet = bytearray([CMD_SCHEDULE_REMOVE_ALL])
     confirm_remove_all = 46140
-    packet.extend(confirm_remove_all.to_bytes(2))
-    return packet
+    return _REMOVE_ALL_SCHEDULES.pack(CMD_SCHEDULE_REMOVE_ALL,
+                                      confirm_remove_all)
+
+_READ_ENERGY_INFO = struct.Struct('>Bx')
 
-def read_energy_info() -> bytearray:
+def read_energy_info() -> bytes:
     """Untested. Reconstructed from Zuli Android app"""
-    return bytearray([CMD_ENERGY_READ_INFO, 0])
+    return _READ_ENERGY_INFO.pack(CMD_ENERGY_READ_INFO)
+
+_READ_ENERGY_INFO_RESPONSE = struct.Struct('>BxBHH')
 
 def parse_read_energy_info(response: bytearray) -> tuple[int, int, int, int]:
-    a = response[2]
-    b = response[4]
-    c = int.from_bytes(response[5:7])
-    d = int.from_bytes(response[7:9])
-    return (a, b, c, d)
+    return _READ_ENERGY_INFO_RESPONSE.unpack_from(response, 2)
+
+_READ_LATCH_DATA = struct.Struct('>BxH')
 
-def read_latch_data(latch_id: int) -> bytearray:
+def read_latch_data(latch_id: int) -> bytes:
     """Untested. Reconstructed from Zuli Android app"""
-    packet = bytearray([CMD_ENERGY_READ_LATCH, 0])
-    packet.extend(latch_id.to_bytes(2))
-    return packet
+    return _READ_LATCH_DATA.pack(CMD_ENERGY_READ_LATCH, latch_id)
+
+# Value (7 bytes), duration (5 bytes), unix time in seconds, milliseconds; the
+# odd sized fields are split into the widest integers struct can unpack
+_READ_LATCH_DATA_RESPONSE = struct.Struct('>BHIBIIH')
 
 def parse_read_latch_data(response: bytearray) -> tuple[int, int, int, int]:
     """Untested. Reconstructed from Zuli Android app"""
-    value = int.from_bytes(response[2:9])
-    duration = int.from_bytes(response[9:14])
-    unix_time_sec = int.from_bytes(response[14:18])
-    unix_time_ms = int.from_bytes(response[18:20])
+    value_hi, value_mid, value_lo, duration_hi, duration_lo, unix_time_sec, \
+        unix_time_ms = _READ_LATCH_DATA_RESPONSE.unpack_from(response, 2)
+    value = value_hi << 48 | value_mid << 32 | value_lo
+    duration = duration_hi << 32 | duration_lo
     return (value, duration, unix_time_sec, unix_time_ms)
 
-def reset_all_latches(num_latches: int) -> bytearray:
+# Command, number of latches, confirmation
+_RESET_ALL_LATCHES = struct.Struct('>BxHH')
+
+def reset_all_latches(num_latches: int) -> bytes:
     """Untested. Reconstructed from Zuli Android app"""
-    packet = bytearray([CMD_ENERGY_LATCH_RESET_ALL, 0])
-    packet.extend(num_latches.to_bytes(2))
     confirm_reset_all = 5693
-    packet.extend(confirm_reset_all.to_bytes(2))
-    return packet
+    return _RESET_ALL_LATCHES.pack(CMD_ENERGY_LATCH_RESET_ALL, num_latches,
+                                   confirm_reset_all)
+
+# Command (sent twice), confirmation
+_RESET_PLUG = struct.Struct('>BBxH')
 
-def reset_plug() -> bytearray:
+def reset_plug() -> bytes:
     """Untested. Reconstructed from Zuli Android app"""
-    packet = bytearray([CMD_RESET, CMD_RESET, 0])
     confirm_reset = 22890
-    packet.extend(confirm_reset.to_bytes(2))
-    return packet
\ No newline at end of file
+    return _RESET_PLUG.pack(CMD_RESET, CMD_RESET, confirm_reset)
\ No newline at end of file
@@ -1,59 +1,287 @@
+from __future__ import annotations
 import asyncio
 import zcs
 import smartplug
 import sys
+import os
+import bisect
+import collections
+import functools
+import threading
+import uuid
 import argparse
 import argparsei
 from datetime import time
 from bleak import BleakScanner
 from bleak import BleakClient
 
-def filter_devices(devices: dict[str, BleakClient], addresses: list[str]):
+try:
+    from prompt_toolkit import PromptSession
+    from prompt_toolkit.patch_stdout import patch_stdout
+    HAVE_PROMPT_TOOLKIT = True
+except ImportError:
+    HAVE_PROMPT_TOOLKIT = False
+
+# How long --wait gives devices that are still connecting before skipping them
+WAIT_TIMEOUT = 3.0
+# How long to wait before retrying a device whose connection failed, doubling
+# with each consecutive failure up to the maximum
+RETRY_DELAY = 1.0
+MAX_RETRY_DELAY = 60.0
+
+class Devices(dict[str, BleakClient]):
+    """Smartplugs keyed by uppercase address, along with a sorted list of their
+    addresses for finding devices by partial address"""
+    def __init__(self):
+        super().__init__()
+        self.addresses: list[str] = []
+
+    def add(self, address: str, client: BleakClient):
+        self[address] = client
+        bisect.insort(self.addresses, address)
+
+    def remove(self, address: str):
+        del self[address]
+        del self.addresses[bisect.bisect_left(self.addresses, address)]
+
+def filter_devices(devices: Devices,
+                   addresses: list[str]) -> list[BleakClient]:
     # An empty list of addresses returns all devices
     if len(addresses) == 0:
         return list(devices.values())
     
-    # Find devices in dict with (possible) partial addresses
-    # Performance is not great, but the number of devices should always be very
-    # low
+    # Full addresses are found directly, and the devices matching a partial
+    # address are a contiguous run of the sorted addresses
     filtered = []
+    sorted_addresses = devices.addresses
     for addr in addresses:
-        for k, v in devices.items():
-            if k.startswith(addr):
-                filtered.append(v)
-    return filtered
+        addr = addr.upper()
+        if addr in devices:
+            filtered.append(devices[addr])
+            continue
+        for i in range(bisect.bisect_left(sorted_addresses, addr),
+                       len(sorted_addresses)):
+            if not sorted_addresses[i].startswith(addr):
+                break
+            filtered.append(devices[sorted_addresses[i]])
+    # Overlapping addresses should not send a device the same command twice
+    return list(dict.fromkeys(filtered))
+
+def print_result(result) -> None:
+    if isinstance(result, bytearray):
+        print(result.hex())
+    else:
+        print(result)
     
 def wrap_method(smartplug_func):
     """Because methods in the smartplug module do not understand command line
     arguments from argparse.Namespace objects, this method creates and returns
     a wrapper method that reads command line arguments and then calls a
-    specified method in the smartplug module."""
-    async def do(args: argparse.Namespace, devices: dict[str, BleakClient]):
-        command_devices = filter_devices(devices, args.devices)
-        method_params = args.params(args) if hasattr(args, 'params') else []
-        async for result in smartplug_func(command_devices, *method_params):
-            if isinstance(result, bytearray):
-                print(result.hex())
+    specified method in the smartplug module.
+
+    The smartplug method may either be an async generator of results or a
+    coroutine returning a single result."""
+    async def do(args: argparse.Namespace, devices: Devices) -> None:
+        clients = filter_devices(devices, args.devices)
+        if args.wait:
+            await asyncio.gather(*[smartplug.wait_ready(client, WAIT_TIMEOUT)
+                                   for client in clients])
+        command_devices: list[BleakClient] = []
+        for client in clients:
+            if smartplug.is_ready(client):
+                command_devices.append(client)
             else:
-                print(result)
+                print(f"Skipping {client.address} (not connected)")
+        method_params = args.params(args)
+        results = smartplug_func(command_devices, *method_params)
+        if asyncio.iscoroutine(results):
+            print_result(await results)
+        else:
+            async for result in results:
+                print_result(result)
     return do
     
-async def list_devices(args: argparse.Namespace,
-                       devices: dict[str, BleakClient]):
+async def list_devices(args: argparse.Namespace, devices: Devices):
     for client in devices.values():
         print(client.address)
 
+async def no_command(args: argparse.Namespace, devices: Devices):
+    """Does nothing, for lines that name no command"""
+    pass
+
+class StdinReader():
+    """Reads lines from standard input on the event loop rather than handing
+    each read off to a worker thread"""
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self.fd = sys.stdin.fileno()
+        self.buffer = bytearray()
+        self.lines: collections.deque[bytearray] = collections.deque()
+        self.waiter: asyncio.Future[None] | None = None
+        self.eof = False
+        # Raises if the loop cannot watch stdin (e.g. on Windows or when stdin
+        # is redirected from a regular file)
+        loop.add_reader(self.fd, self.on_readable)
+
+    def on_readable(self):
+        data = os.read(self.fd, 4096)
+        if data:
+            self.buffer.extend(data)
+            *lines, rest = self.buffer.split(b'\n')
+            self.lines.extend(lines)
+            self.buffer = rest
+        else:
+            self.eof = True
+            self.loop.remove_reader(self.fd)
+            if self.buffer:
+                self.lines.append(self.buffer)
+        if self.waiter is not None and not self.waiter.done() and \
+                (self.lines or self.eof):
+            self.waiter.set_result(None)
+
+    async def readline(self) -> str | None:
+        """Returns the next line without its newline, or None once stdin is
+        exhausted"""
+        while not self.lines:
+            if self.eof:
+                return None
+            self.waiter = self.loop.create_future()
+            await self.waiter
+        return self.lines.popleft().decode(sys.stdin.encoding)
+
+class StdinThread():
+    """Reads lines from standard input on one background thread, for when the
+    event loop cannot watch stdin itself"""
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.lines: asyncio.Queue[str | None] = asyncio.Queue()
+        threading.Thread(target=self.run, args=(loop,), daemon=True).start()
+
+    def run(self, loop: asyncio.AbstractEventLoop):
+        try:
+            for line in sys.stdin:
+                loop.call_soon_threadsafe(self.lines.put_nowait,
+                                          line.rstrip('\n'))
+            loop.call_soon_threadsafe(self.lines.put_nowait, None)
+        except RuntimeError:
+            # The event loop closed while waiting for input
+            pass
+
+    async def readline(self) -> str | None:
+        """Returns the next line without its newline, or None once stdin is
+        exhausted"""
+        return await self.lines.get()
+
+_stdin_reader: StdinReader | StdinThread | None = None
+_prompt_session: PromptSession[str] | None = None
+
 async def ainput(prompt: str) -> str:
+    """Prompts for a line of input, returning "quit" once stdin is exhausted
+
+    When prompt_toolkit is installed and stdin is a terminal, the prompt also
+    supports line editing and history."""
+    global _stdin_reader, _prompt_session
+    if _stdin_reader is None and _prompt_session is None and \
+            HAVE_PROMPT_TOOLKIT and sys.stdin.isatty():
+        _prompt_session = PromptSession()
+    if _prompt_session is not None:
+        # Output printed while the prompt is shown is drawn above it rather
+        # than over the line being typed
+        with patch_stdout():
+            try:
+                return await _prompt_session.prompt_async(f"{prompt} ")
+            except EOFError:
+                return "quit"
+    if _stdin_reader is None:
+        loop = asyncio.get_running_loop()
+        try:
+            _stdin_reader = StdinReader(loop)
+        except (NotImplementedError, PermissionError):
+            _stdin_reader = StdinThread(loop)
     print(f"{prompt} ", end='', flush=True)
-    return (await asyncio.to_thread(sys.stdin.readline)).rstrip('\n')
-    
+    line = await _stdin_reader.readline()
+    return "quit" if line is None else line
+
+def fast_command(subparser: argparse.ArgumentParser, *positionals):
+    """Creates a parser for a subcommand that builds its namespace directly
+    from the tokens following the subcommand name, skipping argparse
+
+    :param positionals: (dest, type) pairs in the order their tokens appear; an
+        omitted token takes the subparser's default for it unless that default
+        is None
+    :returns: a function of the tokens that returns None whenever the full
+        argparse machinery is needed (e.g. to report an error)
+    """
+    defaults = {'func': subparser.get_default('func')}
+    if subparser.get_default('params') is not None:
+        defaults['params'] = subparser.get_default('params')
+    optional = {dest: subparser.get_default(dest) for dest, _ in positionals}
+    def parse(tokens: list[str]) -> argparse.Namespace | None:
+        if len(tokens) > len(positionals):
+            return None
+        args = argparse.Namespace(devices=[], wait=False, **defaults)
+        for i, (dest, type) in enumerate(positionals):
+            if i < len(tokens):
+                try:
+                    value = type(tokens[i])
+                except ValueError:
+                    return None
+            elif optional[dest] is not None:
+                value = optional[dest]
+            else:
+                return None
+            setattr(args, dest, value)
+        return args
+    return parse
+
+def one_of(*choices: str):
+    """Creates a type for a fast command positional that only accepts the given
+    choices"""
+    def convert(token: str) -> str:
+        if token not in choices:
+            raise ValueError(token)
+        return token
+    return convert
+
+@functools.lru_cache(maxsize=64)
+def parse_fast_command(parser: argparsei.InteractiveArgumentParser,
+                       command: str) -> argparse.Namespace | None:
+    """Parses a line with the parser's fast commands, returning None if the line
+    needs argparse
+
+    Lines are often repeated (e.g. polling power), so namespaces are cached by
+    line and shared between calls; they must not be modified."""
+    tokens = command.split()
+    if tokens and not any(token.startswith('-') for token in tokens):
+        fast = parser.fast_commands.get(tokens[0])
+        if fast is not None:
+            return fast(tokens[1:])
+    return None
+
+def parse_command(parser: argparsei.InteractiveArgumentParser,
+                  command: str) -> argparse.Namespace:
+    """Parses a line entered at the prompt, using the parser's fast commands
+    where possible and falling back to argparse for anything with options"""
+    args = parse_fast_command(parser, command)
+    if args is None:
+        # Never cached, since argparse may act on the line while parsing it
+        # (e.g. printing help for --help)
+        args = parser.parse_args(command.split())
+    return args
+
 def configure_parser():
     parser = argparsei.InteractiveArgumentParser(prog="zuli", exit_on_error=False)
     subparsers = parser.add_subparsers()
+    # Every namespace has a func to call, and every subcommand taking devices
+    # has params, so neither needs to be checked for before use
+    parser.set_defaults(func=no_command)
 
     parent_parser = argparsei.InteractiveArgumentParser(add_help=False)
+    parent_parser.set_defaults(params=lambda a : [])
     parent_parser.add_argument('-d', '--devices', action='extend', nargs='*',
                                type=str, default=[])
+    parent_parser.add_argument('-w', '--wait', action='store_true',
+                               help="wait for devices that are still "
+                                    "connecting")
 
     parser_on = subparsers.add_parser('on', parents=[parent_parser])
     parser_on.add_argument('brightness', nargs='?', default=0, type=int)
@@ -64,7 +292,8 @@ def configure_parser():
     parser_off.set_defaults(func=wrap_method(smartplug.off))
 
     parser_mode = subparsers.add_parser('mode', parents=[parent_parser])
-    parser_mode.add_argument('mode', choices=['dimmable', 'appliance'])
+    modes = ['dimmable', 'appliance']
+    parser_mode.add_argument('mode', choices=modes)
     parser_mode.set_defaults(func=wrap_method(smartplug.set_mode),
                                 params=lambda a : [a.mode == 'appliance'])
     
@@ -91,7 +320,8 @@ def configure_parser():
     parser_schedule_add = subparsers.add_parser('add_schedule',
                                                 parents=[parent_parser])
     parser_schedule_add.add_argument('time', type=time.fromisoformat)
-    parser_schedule_add.add_argument('action', choices=['on', 'off'])
+    actions = ['on', 'off']
+    parser_schedule_add.add_argument('action', choices=actions)
     def schedule_params(a):
         return [zcs.Schedule(time=a.time, action=zcs.Schedule.ACTION_OFF
                                             if a.action == "off"
@@ -104,24 +334,110 @@ def configure_parser():
 
     subparsers.add_parser('quit')
 
+    # The most common commands take no options and at most a simple positional
+    # argument, so their namespaces can be built without argparse
+    parser.fast_commands.update({
+        'on': fast_command(parser_on, ('brightness', int)),
+        'off': fast_command(parser_off),
+        'mode': fast_command(parser_mode, ('mode', one_of(*modes))),
+        'power': fast_command(parser_power),
+        'time': fast_command(parser_time),
+        'synctime': fast_command(parser_synctime),
+        'schedules': fast_command(parser_schedule),
+        'remove_schedule': fast_command(parser_schedule_remove,
+                                        ('schedule', int)),
+        'add_schedule': fast_command(parser_schedule_add,
+                                     ('time', time.fromisoformat),
+                                     ('action', one_of(*actions))),
+        'devices': fast_command(parser_devices),
+    })
+
     return parser
 
+_parser = None
+
+def get_parser() -> argparsei.InteractiveArgumentParser:
+    """Returns the command parser, building it on first use"""
+    global _parser
+    if _parser is None:
+        _parser = configure_parser()
+    return _parser
+
+def scanner_args() -> dict:
+    """Returns the keyword arguments for the scanner that discovers smartplugs
+
+    Setting ZULI_SCAN_MODE=passive listens for advertisements without sending
+    scan requests, which takes less radio time while the REPL runs. This is only
+    supported by BlueZ with its experimental advertisement monitor enabled, so
+    the default remains an active scan."""
+    args = {
+        'service_uuids': [zcs.ZULI_SERVICE],
+        # Have BlueZ drop other devices and repeated advertisements before
+        # they ever reach Python; other backends ignore this
+        'bluez': {'filters': {'UUIDs': [zcs.ZULI_SERVICE],
+                              'DuplicateData': False}},
+    }
+    if os.environ.get('ZULI_SCAN_MODE') == 'passive':
+        # Only importable where the BlueZ backend is available
+        from bleak.assigned_numbers import AdvertisementDataType
+        from bleak.backends.bluezdbus.advertisement_monitor import OrPattern
+        # Passive scans cannot filter by service_uuids (bleak warns if they are
+        # given) and instead match advertised 128-bit service UUIDs, which are
+        # sent little endian
+        service = uuid.UUID(zcs.ZULI_SERVICE).bytes[::-1]
+        del args['service_uuids']
+        args['scanning_mode'] = 'passive'
+        args['bluez'] = {'or_patterns': [
+            OrPattern(0, AdvertisementDataType.COMPLETE_LIST_SERVICE_UUID128,
+                      service),
+            OrPattern(0, AdvertisementDataType.INCOMPLETE_LIST_SERVICE_UUID128,
+                      service),
+        ]}
+    return args
+
 async def main():
-    devices = {}
+    devices = Devices()
     async def discover():
-        async with BleakScanner(service_uuids=[zcs.ZULI_SERVICE]) as scanner:
+        async with BleakScanner(**scanner_args()) as scanner:
             connect_tasks = set()
+            # Nearly every advertisement is from a device that is already
+            # known, so check its address as reported before normalizing it
+            seen = set()
+            failures: dict[str, int] = {}
+            async def connect(raw_address: str, address: str,
+                              client: BleakClient):
+                try:
+                    await smartplug.connect(client)
+                except Exception as e:
+                    print(f"Failed to connect to {address} ({e})")
+                    # Back off so a smartplug that can never connect is not
+                    # retried in a tight loop, then forget the device so its
+                    # next advertisement retries
+                    failures[address] = failures.get(address, 0) + 1
+                    await asyncio.sleep(min(MAX_RETRY_DELAY, RETRY_DELAY
+                                            * 2 ** (failures[address] - 1)))
+                    devices.remove(address)
+                    seen.discard(raw_address)
+                else:
+                    failures.pop(address, None)
             async for (device, advertisement_data) in scanner.advertisement_data():
-                if device.address not in devices:
-                    client = BleakClient(device)
-                    devices[device.address] = client
-                    task = asyncio.create_task(client.connect())
+                if device.address in seen:
+                    continue
+                seen.add(device.address)
+                address = sys.intern(device.address.upper())
+                if address not in devices:
+                    # Only the Zuli service is used, so there is no need to
+                    # discover the rest of the GATT table when connecting
+                    client = BleakClient(device, services=[zcs.ZULI_SERVICE])
+                    devices.add(address, client)
+                    task = asyncio.create_task(
+                        connect(device.address, address, client))
                     connect_tasks.add(task)
                     task.add_done_callback(connect_tasks.discard)
     discovery_task = asyncio.create_task(discover())
     try:
         print("Ready. Devices will continue to connect in the background")
-        parser = configure_parser()
+        parser = get_parser()
 
         while True:
             command = await ainput(">>>")
@@ -129,16 +445,19 @@ async def main():
                 break
 
             try:
-                args = parser.parse_args(command.split())
-                if hasattr(args, 'func'):
-                    await args.func(args, devices)
+                args = parse_command(parser, command)
+                await args.func(args, devices)
             except Exception as e:
                 print(e)
     except Exception as e:
         print(e)
     finally:
         print(f"Closing all connections")
-        await asyncio.gather(*[client.disconnect()
-                                for client in devices.values()])
+        # A device that fails to disconnect should not keep the others from
+        # being waited on
+        await asyncio.gather(*[smartplug.disconnect(client)
+                                for client in devices.values()],
+                             return_exceptions=True)
 
-asyncio.run(main())
\ No newline at end of file
+if __name__ == '__main__':
+    asyncio.run(main())
\ No newline at end of file